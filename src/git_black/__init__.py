@@ -1,8 +1,10 @@
 import logging
+import os
 import re
 import sys
 import time
-from bisect import bisect
+from array import array
+from bisect import bisect, insort
 from collections import namedtuple
 from concurrent.futures import (
     FIRST_COMPLETED,
@@ -11,46 +13,23 @@ from concurrent.futures import (
     wait,
 )
 from dataclasses import dataclass
-from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from io import BytesIO
-from subprocess import PIPE, Popen
-from threading import Lock
-from typing import Dict, List, Tuple
+from operator import attrgetter
+from subprocess import PIPE, CalledProcessError, Popen, check_output
+from typing import FrozenSet, Iterator, List, Tuple
 
 import click
 from pygit2 import (
     GIT_DELTA_MODIFIED,
     GIT_DIFF_IGNORE_SUBMODULES,
-    GIT_FILEMODE_BLOB,
-    GIT_STATUS_INDEX_DELETED,
-    GIT_STATUS_INDEX_MODIFIED,
-    GIT_STATUS_INDEX_NEW,
-    GIT_STATUS_INDEX_RENAMED,
-    GIT_STATUS_INDEX_TYPECHANGE,
-    Commit,
-    DiffHunk,
     IndexEntry,
-    Oid,
-    Patch,
     Repository,
     Signature,
 )
 
 logger = logging.getLogger(__name__)
 
-index_statuses = (
-    GIT_STATUS_INDEX_NEW
-    | GIT_STATUS_INDEX_MODIFIED
-    | GIT_STATUS_INDEX_DELETED
-    | GIT_STATUS_INDEX_RENAMED
-    | GIT_STATUS_INDEX_TYPECHANGE
-)
-
-
-def commit_datetime(commit: Commit):
-    tzinfo = timezone(timedelta(minutes=commit.commit_time_offset))
-    return datetime.fromtimestamp(float(commit.commit_time), tzinfo)
-
 
 @dataclass(frozen=True)
 class Delta:
@@ -64,24 +43,6 @@ class Delta:
     new_length: int
     new_lines: List[bytes]
 
-    @property
-    def offset(self):
-        return self.new_length - self.old_length
-
-    @staticmethod
-    def from_hunk(hunk: DiffHunk, filename):
-        old_lines = [line.raw_content for line in hunk.lines if line.origin == "-"]
-        new_lines = [line.raw_content for line in hunk.lines if line.origin == "+"]
-        return Delta(
-            filename=filename,
-            old_start=hunk.old_start,
-            old_length=hunk.old_lines,
-            old_lines=old_lines,
-            new_start=hunk.new_start,
-            new_length=hunk.new_lines,
-            new_lines=new_lines,
-        )
-
     def __str__(self):
         s = [
             "Delta(",
@@ -106,156 +67,302 @@ class Delta:
 DeltaBlame = namedtuple("DeltaBlame", "delta commits")
 
 
-blame_re = re.compile(rb"^(?P<commit>[0-9a-f]{40}) (\d+) (?P<lineno>\d+).*")
+hunk_header_re = re.compile(rb"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
 
 
-class HunkBlamer:
-    def __init__(self, repo, patch: Patch):
-        self.repo = repo
-        self.patch = patch
-        self.filename = patch.delta.old_file.path
-        # self._load_blame()
-        # self._blame_obj = self.repo.blame(self.filename)
-        self._load_blame()
+def iter_deltas(patch_data: bytes, filename) -> Iterator[Delta]:
+    """
+    scan the text of a patch generated with 0 context lines and
+    yield a Delta for each of its hunks
 
-    def _load_blame(self):
-        # libgit2 blame is currently much much slower than calling an external
-        # git command: https://github.com/libgit2/libgit2/issues/3027
+    lines are kept as bytes, just as they are in the file
+    """
 
-        blame_proc = Popen(
-            ["git", "blame", "--porcelain", "HEAD", self.filename], stdout=PIPE
+    def make_delta():
+        old_start, old_length, new_start, new_length = header.groups(b"1")
+        return Delta(
+            filename=filename,
+            old_start=int(old_start),
+            old_length=int(old_length),
+            old_lines=old_lines,
+            new_start=int(new_start),
+            new_length=int(new_length),
+            new_lines=new_lines,
         )
-        self._blame_map = {}
-        for line in blame_proc.stdout:
-            m = blame_re.match(line)
-            if not m:
-                continue
-            commit = m.group("commit").decode("ascii")
-            lineno = int(m.group("lineno"))
-            self._blame_map[lineno] = commit
 
-    def _blame(self, lineno) -> str:
-        return self._blame_map[lineno]
+    # reformatted code has lots of identical lines (blank lines, closing
+    # brackets...); keep a single copy of each of them
+    interned = {}
+
+    header = None
+    # lines are read one at a time and keep their "\n"
+    for line in BytesIO(patch_data):
+        origin = line[:1]
+        if origin == b"@":
+            if header:
+                yield make_delta()
+            header = hunk_header_re.match(line)
+            old_lines = []
+            new_lines = []
+        elif header is None:
+            # file headers before the first hunk
+            continue
+        elif origin == b"-":
+            line = line[1:]
+            old_lines.append(interned.setdefault(line, line))
+            last_lines = old_lines
+        elif origin == b"+":
+            line = line[1:]
+            new_lines.append(interned.setdefault(line, line))
+            last_lines = new_lines
+        elif origin == b"\\":
+            # "\ No newline at end of file"
+            last_lines[-1] = last_lines[-1][:-1]
+    if header:
+        yield make_delta()
+
+
+# header of each group of lines in the output of `git blame --incremental`
+blame_re = re.compile(
+    rb"^(?P<commit>[0-9a-f]{40}) (\d+) (?P<lineno>\d+) (?P<num_lines>\d+)$"
+)
+
+
+@lru_cache(maxsize=4096)
+def _map_lines_by_shape(old_length, new_length) -> Tuple[Tuple[int, ...], ...]:
+    """
+    return tuples that map ranges of source lines to ranges of
+    destination lines. Each (src_first, src_end, dst_first, dst_end)
+    tuple represents a set of source lines (src_first to src_end,
+    exclusive) that became the destination lines (dst_first to dst_end).
+
+    only the shape of the delta matters, so the result is cached and
+    shared by all the deltas with the same old and new lengths.
 
-    def _map_lines(self, delta: Delta) -> Dict[Tuple, Tuple]:
+    although weird, the line numbers are 0-indexed.
+
+    e.g.
+    (   # src_first, src_end, dst_first, dst_end
+        (0, 2, 0, 1),  # the first 2 lines collapsed into the first line of the output
+        (2, 3, 1, 4),  # the third line expanded into lines 2 3 and 4
+    )
+    """
+
+    # this is harder than I thought; I'll start with a super naive
+    # approach and improve it later (or never)
+
+    if old_length == 0:
+        return ((0, 0, 0, new_length),)
+    if new_length == 0:
+        return ((0, old_length, 0, 0),)
+
+    result = [(i, i + 1, i, i + 1) for i in range(min(old_length, new_length) - 1)]
+
+    if old_length >= new_length:
+        result.append((new_length - 1, old_length, new_length - 1, new_length))
+    else:
+        result.append((old_length - 1, old_length, old_length - 1, new_length))
+
+    return tuple(result)
+
+
+class HunkBlamer:
+    def __init__(self, filename, patch_data: bytes, old_is_empty=False):
+        self.filename = filename
+        self.hunk_deltas = list(iter_deltas(patch_data, filename))
+        self.old_is_empty = old_is_empty
+        self._last_blame_idx = 0
+        self._commit_sets = {}
+        self._load_blame()
+
+    @staticmethod
+    def _line_span(start, length) -> Tuple[int, int]:
         """
-        return a dict that maps tuples of source lines
-        to tuples of destination lines. Each key/value pair
-        in the dict represents a set of source lines (the key tuple)
-        that became the destination lines (the value tuple).
-
-        although weird, the numbers in the tuples are 0-indexed.
-
-        e.g.
-        {   # src: dst
-            (0,1): (0)     # the first 2 lines collapsed into the first line of the output
-            (2,): (1,2,3)  # the third line expanded into lines 2 3 and 4
-        }
+        return the first and last lines that are blamed for the
+        lines in [start, start + length)
         """
+        # insertions at the top of the file have start == 0
+        first = max(1, start)
+        last = max(first, start + length - 1)
+        return first, last
+
+    def _line_ranges(self) -> List[Tuple[int, int]]:
+        # the hunks come in order, so merging them as they come is enough
+        line_ranges = []
+        for hd in self.hunk_deltas:
+            first, last = self._line_span(hd.old_start, max(1, hd.old_length))
+            if line_ranges and first <= line_ranges[-1][1] + 1:
+                line_ranges[-1] = (line_ranges[-1][0], max(last, line_ranges[-1][1]))
+            else:
+                line_ranges.append((first, last))
+        return line_ranges
 
-        # this is harder than I thought; I'll start with a super naive
-        # approach and improve it later (or never)
+    def _load_blame(self):
+        # only the lines touched by the hunks are ever looked up, so
+        # there's no need to blame the rest of the file
+        line_ranges = self._line_ranges()
+        if not line_ranges:
+            self._blame_starts, self._blame_commits = array("l"), []
+            return
 
-        if delta.old_length == 0:
-            return {(): tuple(range(delta.new_length))}
-        if delta.new_length == 0:
-            return {tuple(range(delta.old_length)): ()}
+        if self.old_is_empty:
+            # there are no lines to blame (git blame -L fails on an empty
+            # file); the new lines come from the commit that left it empty
+            self._blame_starts, self._blame_commits = self._last_commit()
+            return
 
-        result: Dict[Tuple[int, ...], Tuple[int, ...]] = {}
+        self._blame_starts, self._blame_commits = self._run_blame(line_ranges)
 
-        for i in range(min(delta.old_length, delta.new_length) - 1):
-            result[(i,)] = (i,)
+    def _run_blame(self, line_ranges):
+        # libgit2 blame is currently much much slower than calling an external
+        # git command: https://github.com/libgit2/libgit2/issues/3027
 
-        if delta.old_length >= delta.new_length:
-            result[tuple(range(delta.new_length - 1, delta.old_length))] = (
-                delta.new_length - 1,
-            )
-        else:
-            result[(delta.old_length - 1,)] = tuple(
-                range(delta.old_length - 1, delta.new_length)
-            )
+        # unlike --porcelain, --incremental doesn't repeat the contents of
+        # the file, but the groups come in no particular order
+        args = ["git", "blame", "--incremental"]
+        for first, last in line_ranges:
+            args += ["-L", "{},{}".format(first, last)]
+        args += ["HEAD", "--", self.filename]
+        groups = []
+        with Popen(args, stdout=PIPE) as blame_proc:
+            for line in blame_proc.stdout:
+                m = blame_re.match(line)
+                if not m:
+                    continue
+                groups.append((int(m.group("lineno")), m.group("commit")))
+        if blame_proc.returncode != 0:
+            raise CalledProcessError(blame_proc.returncode, args)
+        groups.sort()
+
+        starts = array("l", [start for start, commit in groups])
+        commits = [commit.decode("ascii") for start, commit in groups]
+        return starts, commits
+
+    def _last_commit(self):
+        args = ["git", "log", "-1", "--format=%H", "HEAD", "--", self.filename]
+        commit = check_output(args).decode("ascii").strip()
+        # insertions into an empty file are all blamed on line 1
+        return array("l", [1]), [commit]
+
+    def _blame_range(self, start, length) -> FrozenSet[str]:
+        """
+        return the commits of all the lines in [start, start + length)
 
-        return result
+        the lines are never looked up one by one; a range can only
+        span the blame groups between the ones holding its first
+        and last line
+        """
+        first, last = self._line_span(start, length)
+
+        # deltas are blamed in order, so the search can usually start
+        # from the group where the previous one started
+        starts = self._blame_starts
+        lo = self._last_blame_idx
+        if lo and first < starts[lo]:
+            lo = 0
+        i = bisect(starts, first, lo=lo) - 1
+        j = bisect(starts, last, lo=i)
+        self._last_blame_idx = max(i, 0)
+
+        # most deltas share their commits with many others; sharing the
+        # sets also keeps the pickled blames small
+        commits = frozenset(self._blame_commits[i:j])
+        return self._commit_sets.setdefault(commits, commits)
+
+    def _map_lines(self, delta: Delta) -> Tuple[Tuple[int, ...], ...]:
+        return _map_lines_by_shape(delta.old_length, delta.new_length)
 
     def blames(self) -> List[DeltaBlame]:
-        hunk_deltas = [
-            Delta.from_hunk(hunk, self.filename) for hunk in self.patch.hunks
-        ]
-
         # let's map each hunk to its source commits and break down the deltas
         # in smaller chunks; this will make it possible to prepare and group
         # commits with a much smaller granularity
         deltas = []
-        for hd in hunk_deltas:
-            for old_linenos, new_linenos in self._map_lines(hd).items():
-                old_start = hd.old_start + min(old_linenos, default=0)
-                old_lines = [hd.old_lines[lineno] for lineno in old_linenos]
-                new_start = hd.new_start + min(new_linenos, default=0)
-                new_lines = [hd.new_lines[lineno] for lineno in new_linenos]
+        for hd in self.hunk_deltas:
+            for old_first, old_end, new_first, new_end in self._map_lines(hd):
                 delta = Delta(
                     filename=self.filename,
-                    old_start=old_start,
-                    old_lines=old_lines,
-                    old_length=len(old_linenos),
-                    new_start=new_start,
-                    new_lines=new_lines,
-                    new_length=len(new_lines),
+                    old_start=hd.old_start + old_first,
+                    old_lines=hd.old_lines[old_first:old_end],
+                    old_length=old_end - old_first,
+                    new_start=hd.new_start + new_first,
+                    new_lines=hd.new_lines[new_first:new_end],
+                    new_length=new_end - new_first,
                 )
                 deltas.append(delta)
 
         blames = []
-        for i, delta in enumerate(deltas):
-            delta_blame = DeltaBlame(delta=delta, commits=set())
-            for line in range(
-                delta.old_start, delta.old_start + max(1, delta.old_length)
-            ):
-                commit = self._blame(line)
-                delta_blame.commits.add(commit)
-            blames.append(delta_blame)
+        for delta in deltas:
+            commits = self._blame_range(delta.old_start, max(1, delta.old_length))
+            blames.append(DeltaBlame(delta=delta, commits=commits))
 
         return blames
 
 
+def blame_deltas(filename, patch_data, old_is_empty=False) -> List[DeltaBlame]:
+    # this runs in worker processes, so it takes and returns only
+    # picklable things; Patch objects are not
+    return HunkBlamer(filename, patch_data, old_is_empty).blames()
+
+
 class Patcher:
-    def __init__(self, repo, filename):
+    def __init__(self, repo, filename, blob_id):
         self.repo = repo
         self.filename = filename
+        self.blob_id = blob_id
         self._load_lines()
-        self._offsets = {}
+        self._patches = []
         self._applied = set()
 
     def _load_lines(self):
-        head = self.repo.head.peel()
-        obj = head.tree
-        for component in self.filename.split("/"):
-            obj = obj / component
-        self._lines = BytesIO(obj.data).readlines()
+        # the diff already knows the blob of the file at HEAD, so there's
+        # no need to look it up in the tree
+        obj = self.repo[self.blob_id]
+        # keep the whole blob in one buffer and only remember where each
+        # line starts; unchanged runs of lines are then sliced out of it
+        # without copying
+        data = obj.data
+        self._data = memoryview(data)
+
+        # scan for the line ends instead of splitting the lines, which
+        # would create a bytes object for each of them
+        offsets = array("L", [0])
+        pos = data.find(b"\n") + 1
+        while pos:
+            offsets.append(pos)
+            pos = data.find(b"\n", pos) + 1
+        if offsets[-1] != len(data):
+            # last line without a newline
+            offsets.append(len(data))
+        self._line_offsets = offsets
 
     def apply(self, delta: Delta):
         if (delta.old_start) in self._applied:
             return
 
-        old_length = delta.old_length
-        old_start = delta.old_start
-        for pos, off in self._offsets.items():
-            if delta.old_start > pos:
-                old_start += off
+        # deltas are relative to the original lines, which are never
+        # modified; they're kept sorted and spliced in by content()
+        i = delta.old_start - 1
 
         # I don't understand why, but hunks need
         # this when the old_length is 0
-        if old_length == 0:
-            old_start += 1
-
-        i = old_start - 1
-        j = i + old_length
-        self._lines[i:j] = delta.new_lines
+        if delta.old_length == 0:
+            i += 1
 
-        self._offsets[delta.old_start] = delta.offset
+        insort(self._patches, (i, i + delta.old_length, delta.new_lines))
 
         self._applied.add(delta.old_start)
 
     def content(self):
-        return b"".join(self._lines)
+        data = self._data
+        offsets = self._line_offsets
+        chunks = []
+        pos = 0
+        for i, j, new_lines in self._patches:
+            chunks.append(data[offsets[pos] : offsets[i]])
+            chunks.extend(new_lines)
+            pos = j
+        chunks.append(data[offsets[pos] :])
+        return b"".join(chunks)
 
 
 class GitIndexNotEmpty(Exception):
@@ -263,20 +370,26 @@ class GitIndexNotEmpty(Exception):
 
 
 class GitBlack:
-    def __init__(self):
+    def __init__(self, numprocesses=None):
         self.repo = Repository(".")
         self.patchers = {}
-
-    def get_blamed_deltas(self, patch):
-        filename = patch.delta.old_file.path
-        self.patchers[filename] = Patcher(self.repo, filename)
-        hb = HunkBlamer(self.repo, patch)
-        return hb.blames()
+        self.numprocesses = numprocesses or os.cpu_count() or 1
 
     def group_blame_deltas(self, blames):
+        # files whose changes map to no deltas are never patched, so
+        # there's no need to load their contents
+        if blames:
+            filename = blames[0].delta.filename
+            self.patchers[filename] = Patcher(
+                self.repo, filename, self._blob_ids[filename]
+            )
+
         for delta_blame in blames:
-            commits = tuple(sorted(delta_blame.commits))
-            self.grouped_deltas.setdefault(commits, []).append(delta_blame.delta)
+            # commits are frozensets: they hash without sorting and
+            # don't depend on order
+            self.grouped_deltas.setdefault(delta_blame.commits, []).append(
+                delta_blame.delta
+            )
 
         self.progress += 1
         now = time.monotonic()
@@ -289,35 +402,50 @@ class GitBlack:
         start = time.monotonic()
         self.grouped_deltas = {}
 
-        for path, status in self.repo.status().items():
-            if status & index_statuses:
-                raise GitIndexNotEmpty
+        # a full status would also scan the whole working tree; only
+        # the index needs to be compared with HEAD here
+        if len(self.repo.index.diff_to_tree(self.repo.head.peel().tree)) > 0:
+            raise GitIndexNotEmpty
 
         patches = []
         self._file_modes = {}
+        self._blob_ids = {}
         diff = self.repo.diff(context_lines=0, flags=GIT_DIFF_IGNORE_SUBMODULES)
         for patch in diff:
+            old_file = patch.delta.old_file
             if patch.delta.status != GIT_DELTA_MODIFIED:
                 continue
-            self._file_modes[patch.delta.old_file.path] = patch.delta.old_file.mode
+            self._file_modes[old_file.path] = old_file.mode
+            self._blob_ids[old_file.path] = old_file.id
             patches.append(patch)
 
         self.progress = 0
         self.last_log = 0
         self.total = len(patches)
 
-        executor = ThreadPoolExecutor(max_workers=8)
-        tasks = set()
-        for patch in patches:
-            tasks.add(executor.submit(self.get_blamed_deltas, patch))
-            if len(tasks) > 8:
-                done, not_done = wait(tasks, return_when=FIRST_COMPLETED)
-                for task in done:
-                    self.group_blame_deltas(task.result())
-                tasks -= set(done)
+        if self.numprocesses > 1 and len(patches) > 1:
+            executor = ProcessPoolExecutor(max_workers=self.numprocesses)
+        else:
+            # not worth starting other processes
+            executor = ThreadPoolExecutor(max_workers=1)
+
+        with executor:
+            tasks = set()
+            for patch in patches:
+                old_file = patch.delta.old_file
+                tasks.add(
+                    executor.submit(
+                        blame_deltas, old_file.path, patch.data, old_file.size == 0
+                    )
+                )
+                if len(tasks) > self.numprocesses:
+                    done, not_done = wait(tasks, return_when=FIRST_COMPLETED)
+                    for task in done:
+                        self.group_blame_deltas(task.result())
+                    tasks -= set(done)
 
-        for task in tasks:
-            self.group_blame_deltas(task.result())
+            for task in tasks:
+                self.group_blame_deltas(task.result())
 
         secs = time.monotonic() - start
         sys.stdout.write(
@@ -331,9 +459,23 @@ class GitBlack:
         self.progress = 0
         self.last_log = 0
 
-        for commits, deltas in self.grouped_deltas.items():
-            blobs = self._create_blobs(deltas)
-            self._commit(commits, blobs)
+        # the committer is the same for every commit
+        self._committer = Signature(
+            name=self.repo.config["user.name"], email=self.repo.config["user.email"]
+        )
+
+        # the same original commits show up in many groups; look each
+        # of them up only once
+        self._commits = {h: self.repo.get(h) for h in set().union(*self.grouped_deltas)}
+
+        # trees are written from the index in memory; the index file
+        # only needs to match HEAD once we're done (or interrupted)
+        try:
+            for commits, deltas in self.grouped_deltas.items():
+                blobs = self._create_blobs(deltas)
+                self._commit(commits, blobs)
+        finally:
+            self.repo.index.write()
 
         secs = time.monotonic() - start
         print(
@@ -359,26 +501,22 @@ class GitBlack:
             index_entry = IndexEntry(filename, blob_id, file_mode)
             self.repo.index.add(index_entry)
 
-        commits = [self.repo.get(h) for h in original_commits]
+        original_commits = sorted(original_commits)
+        commits = [self._commits[h] for h in original_commits]
 
-        main_commit = commits[0]
-        if len(commits) > 1:
-            # most recent commit
-            main_commit = sorted(commits, key=commit_datetime)[-1]
+        # most recent commit; commit_time is a plain timestamp, so there's
+        # no need to build datetimes to compare them. Going backwards
+        # picks the last one on ties, like sorting and taking the last did
+        main_commit = max(reversed(commits), key=attrgetter("commit_time"))
 
         commit_message = main_commit.message
         commit_message += "\n\nautomatic commit by git-black, original commits:\n"
         commit_message += "\n".join(["  {}".format(c) for c in original_commits])
 
-        committer = Signature(
-            name=self.repo.config["user.name"], email=self.repo.config["user.email"],
-        )
-
-        self.repo.index.write()
         tree = self.repo.index.write_tree()
         head = self.repo.head.peel()
         self.repo.create_commit(
-            "HEAD", main_commit.author, committer, commit_message, tree, [head.id]
+            "HEAD", main_commit.author, self._committer, commit_message, tree, [head.id]
         )
         self.progress += 1
         now = time.monotonic()
@@ -389,8 +527,14 @@ class GitBlack:
 
 
 @click.command()
-def cli():
-    gb = GitBlack()
+@click.option(
+    "-n",
+    "--numprocesses",
+    type=click.IntRange(min=1),
+    help="Number of files to read in parallel (defaults to the number of CPUs).",
+)
+def cli(numprocesses):
+    gb = GitBlack(numprocesses=numprocesses)
     try:
         gb.commit_changes()
     except GitIndexNotEmpty:
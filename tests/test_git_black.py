@@ -4,8 +4,15 @@ from textwrap import dedent
 
 import py
 import pytest
+from pygit2 import Repository
 
-from git_black import Delta, GitBlack
+from git_black import (
+    Delta,
+    GitBlack,
+    HunkBlamer,
+    Patcher,
+    iter_deltas,
+)
 
 
 @pytest.fixture
@@ -134,6 +141,242 @@ def test_insert_only(tmp_repo):
     assert git_log() == ["commit2", "commit1"]
 
 
+def test_iter_deltas():
+    patch_data = (
+        b"diff --git a/a.py b/a.py\n"
+        b"index a7bc997..7f02c4a 100644\n"
+        b"--- a/a.py\n"
+        b"+++ b/a.py\n"
+        b"@@ -0,0 +1 @@\n"
+        b"+first\r\n"
+        b"@@ -3,2 +4 @@ def func():\n"
+        b"-    a,\n"
+        b"-    b\n"
+        b"+    a, b\n"
+        b"@@ -9 +9,2 @@\n"
+        b"-last\n"
+        b"\\ No newline at end of file\n"
+        b"+last\n"
+        b"+tail\n"
+        b"\\ No newline at end of file\n"
+    )
+    deltas = list(iter_deltas(patch_data, "a.py"))
+    assert deltas == [
+        Delta("a.py", 0, [], 0, 1, 1, [b"first\r\n"]),
+        Delta("a.py", 3, [b"    a,\n", b"    b\n"], 2, 4, 1, [b"    a, b\n"]),
+        Delta("a.py", 9, [b"last"], 1, 9, 2, [b"last\n", b"tail"]),
+    ]
+
+
+def git_commit_as(msg, author, date):
+    env = dict(os.environ, GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+    run(["git", "commit", "--quiet", "-m", msg, "--author", author], env=env)
+
+
+@pytest.mark.parametrize("numprocesses", [1, 2])
+def test_commit_changes(tmp_repo, numprocesses):
+    run(["git", "config", "user.name", "Black"])
+    run(["git", "config", "user.email", "black@example.com"])
+
+    a = py.path.local("a.py")
+    b = py.path.local("b.py")
+    a.write("a1\na2\na3\na4\n")
+    b.write("b1\nb2\n")
+    git_add(a)
+    git_add(b)
+    git_commit_as("commit1", "Alice <alice@example.com>", "2020-01-01T00:00:00")
+    a.write("a1\na2\nA3\na4\n")
+    b.write("b1\nB2\n")
+    git_add(a)
+    git_add(b)
+    git_commit_as("commit2", "Bob <bob@example.com>", "2020-01-02T00:00:00")
+
+    a.write("A1\na2\nA3a4\n")
+    b.write("b1\nB2!\nb3\n")
+
+    GitBlack(numprocesses=numprocesses).commit_changes()
+
+    repo = Repository(".")
+    head = repo.head.peel()
+    commit2 = repo.revparse_single("HEAD~3")
+    commit1 = repo.revparse_single("HEAD~4")
+    assert commit2.message == "commit2\n"
+    assert commit1.message == "commit1\n"
+
+    def message(main_commit, *original_commits):
+        return (
+            main_commit.message
+            + "\n\nautomatic commit by git-black, original commits:\n"
+            + "\n".join("  {}".format(c) for c in sorted(original_commits))
+        )
+
+    c1, c2 = str(commit1.id), str(commit2.id)
+    generated = [head, head.parents[0], head.parents[0].parents[0]]
+    assert {(c.author.name, c.committer.name, c.message) for c in generated} == {
+        ("Alice", "Black", message(commit1, c1)),
+        ("Bob", "Black", message(commit2, c1, c2)),
+        ("Bob", "Black", message(commit2, c2)),
+    }
+
+    # the last commit has the contents of the working tree, and the
+    # index was written to match it
+    assert head.tree["a.py"].data == b"A1\na2\nA3a4\n"
+    assert head.tree["b.py"].data == b"b1\nB2!\nb3\n"
+    assert run(["git", "status", "--porcelain"], stdout=PIPE).stdout == b""
+
+
+def test_commit_changes_empty_file(tmp_repo):
+    run(["git", "config", "user.name", "Black"])
+    run(["git", "config", "user.email", "black@example.com"])
+
+    a = py.path.local("a.py")
+    b = py.path.local("b.py")
+    a.write("a1\n")
+    git_add(a)
+    git_commit_as("commit1", "Alice <alice@example.com>", "2020-01-01T00:00:00")
+    a.write("")
+    git_add(a)
+    git_commit_as("empty a.py", "Bob <bob@example.com>", "2020-01-02T00:00:00")
+    b.write("b1\n")
+    git_add(b)
+    git_commit_as("add b.py", "Carol <carol@example.com>", "2020-01-03T00:00:00")
+
+    a.write("a1\na2\n")
+
+    GitBlack(numprocesses=1).commit_changes()
+
+    repo = Repository(".")
+    head = repo.head.peel()
+    assert head.author.name == "Bob"
+    assert head.message.startswith("empty a.py\n")
+    assert head.parents[0].message == "add b.py\n"
+    assert head.tree["a.py"].data == b"a1\na2\n"
+    assert run(["git", "status", "--porcelain"], stdout=PIPE).stdout == b""
+
+
+@pytest.mark.parametrize(
+    ("blob", "deltas", "expected"),
+    [
+        # insertion at the top of the file
+        (b"a\nb\nc\n", [((0, 0), [], [b"x\n"])], b"x\na\nb\nc\n"),
+        # insertions after a line and at the bottom
+        (
+            b"a\nb\nc\n",
+            [((2, 0), [], [b"x\n"]), ((3, 0), [], [b"y\n"])],
+            b"a\nb\nx\nc\ny\n",
+        ),
+        # deletion
+        (b"a\nb\nc\n", [((2, 1), [b"b\n"], [])], b"a\nc\n"),
+        # deletion of the whole file
+        (b"a\nb\n", [((1, 2), [b"a\n", b"b\n"], [])], b""),
+        # 3 -> 1 collapse
+        (
+            b"a\nb\nc\nd\n",
+            [((1, 3), [b"a\n", b"b\n", b"c\n"], [b"abc\n"])],
+            b"abc\nd\n",
+        ),
+        # 1 -> 3 expansion
+        (
+            b"a\nb\nc\n",
+            [((2, 1), [b"b\n"], [b"b1\n", b"b2\n", b"b3\n"])],
+            b"a\nb1\nb2\nb3\nc\n",
+        ),
+        # deltas applied out of order
+        (
+            b"a\nb\nc\nd\n",
+            [
+                ((4, 1), [b"d\n"], [b"D\n"]),
+                ((1, 2), [b"a\n", b"b\n"], [b"ab\n"]),
+                ((0, 0), [], [b"x\n"]),
+            ],
+            b"x\nab\nc\nD\n",
+        ),
+        # no newline at end of file
+        (b"a\nb", [((2, 1), [b"b"], [b"B\n"])], b"a\nB\n"),
+        (b"a\nb", [((1, 1), [b"a\n"], [b"A\n"])], b"A\nb"),
+    ],
+)
+def test_patcher_content(tmp_repo, blob, deltas, expected):
+    repo = Repository(".")
+    patcher = Patcher(repo, "a.py", repo.create_blob(blob))
+    assert patcher.content() == blob
+
+    for (old_start, old_length), old_lines, new_lines in deltas:
+        # new_start doesn't matter to the patcher
+        delta = Delta(
+            "a.py", old_start, old_lines, old_length, 0, len(new_lines), new_lines
+        )
+        patcher.apply(delta)
+    assert patcher.content() == expected
+
+
+def test_patcher_content_after_each_delta(tmp_repo):
+    # content() is called once per generated commit, with more deltas
+    # applied each time
+    repo = Repository(".")
+    patcher = Patcher(repo, "a.py", repo.create_blob(b"a\nb\nc\n"))
+
+    patcher.apply(Delta("a.py", 3, [b"c\n"], 1, 3, 1, [b"C\n"]))
+    assert patcher.content() == b"a\nb\nC\n"
+    patcher.apply(Delta("a.py", 0, [], 0, 1, 1, [b"x\n"]))
+    assert patcher.content() == b"x\na\nb\nC\n"
+    patcher.apply(Delta("a.py", 2, [b"b\n"], 1, 3, 0, []))
+    assert patcher.content() == b"x\na\nC\n"
+
+
+class FullFileBlamer(HunkBlamer):
+    def _line_ranges(self):
+        # the whole file as it is at HEAD, which is what gets blamed
+        head_blob = Repository(".").revparse_single("HEAD:" + self.filename)
+        return [(1, len(head_blob.data.splitlines()))]
+
+
+def test_hunk_blamer_line_ranges(tmp_repo):
+    a = py.path.local("a.py")
+    lines = ["line{}\n".format(i) for i in range(1, 9)]
+    a.write("".join(lines))
+    git_add(a)
+    git_commit("commit1")
+    # give neighbouring lines different commits
+    for i in (0, 2, 3, 6):
+        lines[i] = lines[i].upper()
+        a.write("".join(lines))
+        git_add(a)
+        git_commit("commit line{}".format(i + 1))
+
+    a.write(
+        "".join(
+            ["inserted at the top\n"]
+            + lines[0:2]
+            + ["changed3\n"]
+            + lines[3:4]
+            + ["inserted after 4\n"]
+            + lines[4:6]
+            + ["changed7\n"]
+            + lines[7:]
+        )
+    )
+
+    repo = Repository(".")
+    (patch,) = repo.diff(context_lines=0)
+    blamer = HunkBlamer("a.py", patch.data)
+    assert [(hd.old_start, hd.old_length) for hd in blamer.hunk_deltas] == [
+        (0, 0),
+        (3, 1),
+        (4, 0),
+        (7, 1),
+    ]
+    # the insertion at the top is clamped to the first line, and the
+    # insertion after line 4 is merged with the change to line 3
+    assert blamer._line_ranges() == [(1, 1), (3, 4), (7, 7)]
+
+    full_blamer = FullFileBlamer("a.py", patch.data)
+    assert full_blamer._line_ranges() == [(1, 8)]
+    full_blame = full_blamer.blames()
+    assert blamer.blames() == full_blame
+    assert len({blame.commits for blame in full_blame}) == 4
+
+
 # @pytest.mark.parametrize(
 #    ("src", "dst", "expected"),
 #    [